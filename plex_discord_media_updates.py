@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
+import argparse
 import re
 import os
-import requests
+import sys
 import time
 import yaml
 from envsubst import envsubst
+from bisect import bisect_right
 from collections import Counter
-from dhooks import Webhook, Embed
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import accumulate
 from pathlib import Path
-from plexapi.server import PlexServer
 
 '''
 ------------------------------------------------------------------------------
@@ -65,26 +68,55 @@ message would simply fail and not get sent.
 - Initial build
 ------------------------------------------------------------------------------
 '''
-start_time = int(time.time())
-
 os.environ["PLEX_URL"] = os.getenv("PLEX_URL", "https://localhost:32400")
 os.environ["PLEX_TOKEN"] = os.getenv("PLEX_TOKEN", "XXXXXXXXXXXXXXXXXXXXX")
 os.environ["DISCORD_URL"] = os.getenv("DISCORD_URL", "https://discord.com/api/webhooks/XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX")
 os.environ["LOOPBACK_PERIOD"] = os.getenv("LOOPBACK_PERIOD", "24h")
 
+
+class EnvVarLoader(yaml.SafeLoader):
+    """
+    A YAML loader that substitutes environment variables (e.g. "$PLEX_URL")
+    in scalar values only, instead of in the whole config file's text.
+    """
+
+
+def construct_env_str(loader, node):
+    """
+    Constructs a YAML string value with any environment variables in it
+    substituted.
+
+    Arguments:
+    loader -- the YAML loader constructing the value
+    node -- the YAML scalar node of the string value
+    """
+    value = loader.construct_scalar(node)
+    if "$" not in value:
+        return value
+    value = envsubst(value)
+    # Plain (unquoted) values are resolved again once substituted, so that
+    # e.g. "$SKIP_MOVIES" set to "False" still loads as a boolean
+    if node.style is None:
+        tag = loader.resolve(yaml.ScalarNode, value, (True, False))
+        if tag != node.tag:
+            return loader.yaml_constructors[tag](
+                loader, yaml.ScalarNode(tag, value))
+    return value
+
+
+EnvVarLoader.add_constructor("tag:yaml.org,2002:str", construct_env_str)
+
 # Setting variables from config file
 with open(os.getenv("CONFIG_FILE", Path(__file__).with_name("config.yml")), encoding="utf-8") as file:
-    config = yaml.safe_load(envsubst(file.read()))
+    config = yaml.load(file, Loader=EnvVarLoader)
 
 script_config = config["plex_discord_media_updates"]
-try:
-    testing_mode = script_config["testing_mode"]
-except:
-    testing_mode = False
-try:
-    uptime_status = config["uptime_status"]["plex_discord_media_updates"]
-except:
-    uptime_status = None
+testing_mode = script_config.get("testing_mode", False)
+# The uptime status URL is read from the script's own section, falling back
+# to the older top-level "uptime_status" section.
+uptime_status = (script_config.get("uptime_status")
+                 or (config.get("uptime_status") or {})
+                 .get("plex_discord_media_updates"))
 plex_url = config["plex"]["url"]
 plex_token = config["plex"]["token"]
 movie_library = config["plex"]["libraries"]["movies"]
@@ -104,10 +136,20 @@ tv_embed_colour = embed_options["shows_colour"]
 movie_emote = embed_options["movies_emote"]
 tv_emote = embed_options["shows_emote"]
 max_length_exceeded_msg = script_config["overflow_footer"]
+cache_expiry = script_config.get("cache_expiry", 0)
+cache_file = os.getenv("CACHE_FILE",
+                       Path(__file__).with_name("plex_cache.sqlite"))
 
 # Character limit of a discord message including embeds
 message_max_length = 4000
 
+# Matches any string ending with a year between 1000-2999 in parentheses.
+# e.g. "The Flash (2014)"
+year_regex = re.compile(r"\([12][0-9]{3}\)$")
+
+# Matches a lookback period made of an amount and a unit. e.g. "24h"
+period_regex = re.compile(r"([0-9]+)([mhdw])")
+
 if testing_mode:
     webhook_url = script_config["testing"]["webhook"]
 
@@ -122,53 +164,220 @@ def clean_year(media):
     Arguments:
     media -- an object with both .title and .year variables
     """
-    title = ""
-    # year_regex matches any string ending with a year between 1000-2999 in
-    # parentheses. e.g. "The Flash (2014)"
-    year_regex = re.compile(".*\([12][0-9]{3}\)$")
-    title += media.title
-    if not year_regex.match(media.title):
-        title += " (" + str(media.year) + ")"
-    return title
+    title = media.title
+    if year_regex.search(title):
+        return title
+    return f"{title} ({media.year})"
 
 
-def trim_on_newlines(long_string, max_length):
+def plural(count, word, many=None):
     """
-    Takes a long multi-line string and a max length, and returns a subsection
-    of the string that's the max length or shorter, that ends before a
-    newline.
+    Returns the singular or plural form of a word, depending on the count.
 
     Arguments:
-    long_string -- string; any string with a newline character
-    max_length -- integer; denotes the max length to trim the string down to
+    count -- integer; the number of things the word refers to
+    word -- string; the singular form of the word
+    many -- string; optional plural form, defaults to the word with an "s"
     """
-    if len(long_string) > max_length:
-        end = long_string.rfind("\n", 0, max_length)
-        return long_string[:end] + max_length_exceeded_msg
-    else:
-        return long_string + max_length_exceeded_msg
+    if count == 1:
+        return word
+    return many or f"{word}s"
 
 
-def create_embeds(embed_title, embed_description, embed_color, max_length):
+def joined_length(lines):
     """
-    Creates an embed with data from the given arguments, but modifies the
-    description of the embed so be below a given amount of characters. Will
-    only trim the embed at the end of a line to avoid partial lines, while
-    still keeping the description below max_length.
+    Returns the length the given lines would have once joined by newlines,
+    without actually building the joined string.
+
+    Arguments:
+    lines -- list of strings; the lines of an embed description
+    """
+    return sum(map(len, lines)) + len(lines) - 1
+
+
+def create_embeds(embed_title, embed_lines, embed_color, max_length):
+    """
+    Creates and returns an embed with data from the given arguments, but
+    modifies the description of the embed so be below a given amount of
+    characters. Will only trim the embed at the end of a line to avoid
+    partial lines, while still keeping the description below max_length.
 
     Arguments:
     embed_title -- title for the embed
-    embed_description -- description for the embed
+    embed_lines -- list of lines making up the description for the embed
     embed_color -- colour for the embed
     max_length -- integer; the max length for the embed's description
     """
-    if len(embed_description) > max_length:
-        embed_description = trim_on_newlines(embed_description, max_length)
+    from dhooks import Embed
+
+    if joined_length(embed_lines) > max_length:
+        # Length of the description up to and including each line's newline
+        line_ends = list(accumulate(len(line) + 1 for line in embed_lines))
+        end = bisect_right(line_ends, max_length)
+        embed_description = ("\n".join(embed_lines[:end])
+                             + max_length_exceeded_msg)
+    else:
+        embed_description = "\n".join(embed_lines)
     embed = Embed(
         title=embed_title,
         description=embed_description,
         color=embed_color)
-    webhook_embeds.append(embed)
+    return embed
+
+
+def ping_uptime_status(session, start_time):
+    """
+    Pings the uptime status monitor if specified, reporting how many seconds
+    have passed since the given start time.
+
+    Arguments:
+    session -- the requests session used to ping the uptime status monitor
+    start_time -- float; a time.monotonic() timestamp from the start of the run
+    """
+    if not uptime_status:
+        return
+    try:
+        elapsed_time = int(time.monotonic() - start_time)
+        session.get(f"{uptime_status}{elapsed_time}", timeout=5)
+    except Exception as err:
+        print(f"There was an error pinging the uptime status monitor:", err)
+
+
+def run_once(plex, webhook, session):
+    """
+    Retrieves the recently added media from plex and sends it in a message
+    via discord webhook, then pings the uptime status monitor if specified.
+
+    Arguments:
+    plex -- the PlexServer connection to retrieve the media from
+    webhook -- the discord Webhook to send the message with
+    session -- the requests session used to ping the uptime status monitor
+    """
+    start_time = time.monotonic()
+    media_lists = []
+
+    # Searches the libraries concurrently, since each search is an
+    # independent request to the plex server. Skips scanning libraries if
+    # specified.
+    count_episodes = show_individual_episodes or show_total_episodes
+    with ThreadPoolExecutor() as executor:
+        if not skip_movies:
+            movies = plex.library.section(movie_library)
+            # Retrieves all movies added since the start of the lookback
+            # period
+            new_movies_future = executor.submit(
+                movies.search, filters={"addedAt>>": lookback_period})
+        if not skip_tv:
+            shows = plex.library.section(tv_library)
+            # Retrieves all TV shows with episodes added since the start of
+            # the lookback period, already grouped by show on the server.
+            new_shows_future = executor.submit(
+                shows.search, filters={"episode.addedAt>>": lookback_period})
+            # Retrieves the new episodes themselves only if episode counts
+            # are shown
+            if count_episodes:
+                new_eps_future = executor.submit(
+                    shows.searchEpisodes,
+                    filters={"addedAt>>": lookback_period})
+
+    # Skips the movie embed creation/addition if there are no new movies
+    new_movies = [] if skip_movies else new_movies_future.result()
+    if new_movies:
+        # Building movies list
+        movies_lines = [bullet + clean_year(movie) for movie in new_movies]
+        total_movies = len(movies_lines)
+        media_lists.append(movies_lines)
+
+        # Builds the Movies embed title
+        movie_title = (f"{total_movies} {plural(total_movies, 'Movie')}"
+                       f" {movie_emote}")
+
+    # Skips the TV show embed creation/addition if there are no new episodes
+    new_shows = [] if skip_tv else new_shows_future.result()
+    if new_shows:
+        # Building TV shows list
+        # Counts the new episodes per show by the show's unique RatingKey
+        episode_counts = Counter()
+        if count_episodes:
+            episode_counts.update(episode.grandparentRatingKey
+                                  for episode in new_eps_future.result())
+
+        # Picks the show line format once, depending on whether the
+        # number of new episodes is listed for each show
+        if show_individual_episodes:
+            def format_show(title, episode_count):
+                return (f"{bullet}{title} - *{episode_count}"
+                        f" {plural(episode_count, 'episode')}*")
+        else:
+            def format_show(title, episode_count):
+                return bullet + title
+
+        # Pairs each show's title with its number of new episodes, sorted
+        # by title rather than by the formatted line. The shows and episodes
+        # come from separate searches, so every listed show is counted as
+        # having at least one new episode in case they disagree.
+        show_entries = sorted(
+            ((clean_year(show), max(episode_counts[show.ratingKey], 1))
+             for show in new_shows),
+            key=lambda entry: entry[0].casefold())
+        # Builds the properly-formatted list with episode counts
+        show_list = [format_show(title, episode_count)
+                     for title, episode_count in show_entries]
+        # Only counts the episodes of the shows that are listed
+        total_episodes = sum(episode_count
+                             for _, episode_count in show_entries)
+        total_shows = len(show_list)
+        media_lists.append(show_list)
+
+        if show_total_episodes:
+            # Builds the TV Shows embed title with the episode count
+            tv_title = (f"{total_shows} {plural(total_shows, 'Show')} /"
+                        f" {total_episodes}"
+                        f" {plural(total_episodes, 'Episode')}"
+                        f" {tv_emote}")
+        else:
+            # Builds the TV Shows embed title
+            tv_title = (f"{total_shows} {plural(total_shows, 'Show')}"
+                        f" {tv_emote}")
+
+    # Skips building and sending the message if there's no new media
+    if not media_lists:
+        print("No new/specified media to notify about - message not sent.")
+    else:
+        # Building embeds
+        list_count = len(media_lists)
+        if (sum(joined_length(lines) for lines in media_lists)
+                < message_max_length):
+            # Sets to max message length if the sum of both lists is less
+            # than it
+            embed_length = message_max_length
+        else:
+            # Sets to max message length if there is only
+            # one list. Otherwise divides the total embed
+            # length by however many lists there are.
+            embed_length = message_max_length // list_count
+
+        webhook_embeds = []
+        if new_movies:
+            webhook_embeds.append(create_embeds(
+                movie_title, movies_lines, movie_embed_colour, embed_length))
+        if new_shows:
+            webhook_embeds.append(create_embeds(
+                tv_title, show_list, tv_embed_colour, embed_length))
+
+        # Adds thumnail image to embeds if specified
+        if embed_thumbnail:
+            for embed in webhook_embeds:
+                embed.set_thumbnail(embed_thumbnail)
+
+        # Sending webhook
+        try:
+            webhook.send(message_title, embeds=webhook_embeds)
+        except Exception as err:
+            print("There was an error sending the message:", err)
+
+    # Ping uptime status monitor if specified
+    ping_uptime_status(session, start_time)
 
 
 if __name__ == "__main__":
@@ -185,142 +394,92 @@ if __name__ == "__main__":
         "w": "week",
     }
 
+    # Parses the lookback period into its amount and unit
+    period_match = period_regex.fullmatch(lookback_period.strip().lower())
+    if not period_match:
+        raise ValueError(f"Invalid lookback_period: {lookback_period!r}")
+    period_amount = int(period_match[1])
+    period_unit = period_match[2]
+    lookback_period = f"{period_amount}{period_unit}"
+
     # Builds the webhook message that includes the max age of the new media
-    if lookback_period[:-1] == "1":
-        lookback_text = period_dict[lookback_period[-1]]
+    if period_amount == 1:
+        lookback_text = period_dict[period_unit]
     else:
-        lookback_text = (f"{lookback_period[:-1]}"
-                         f" {period_dict[lookback_period[-1]]}s")
+        lookback_text = f"{period_amount} {period_dict[period_unit]}s"
     message_title = f"_ _\n**{message_title} {lookback_text}:**"
 
-    # Initializing plex connection and data structures
-    plex = PlexServer(plex_url, plex_token)
+    # Number of seconds in each lookback period unit, used to schedule runs
+    # in daemon mode
+    period_seconds = {
+        "m": 60,
+        "h": 60 * 60,
+        "d": 24 * 60 * 60,
+        "w": 7 * 24 * 60 * 60,
+    }
+    lookback_seconds = period_amount * period_seconds[period_unit]
+
+    parser = argparse.ArgumentParser(
+        description="Sends recently added plex media to a discord webhook.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running and check for new media once every lookback"
+             " period, reusing the same plex connection")
+    args = parser.parse_args()
+    # Prevents daemon mode from running back-to-back without any delay
+    if args.daemon and not lookback_seconds:
+        parser.error("lookback_period must be longer than 0 in daemon mode")
+
+    # Skips importing the plex library and connecting to plex if both
+    # libraries are skipped, since there's nothing to retrieve
+    if skip_movies and skip_tv:
+        start_time = time.monotonic()
+        print("No new/specified media to notify about - message not sent.")
+        if uptime_status:
+            import requests
+            ping_uptime_status(requests.Session(), start_time)
+        sys.exit()
+
+    # The network libraries are only imported once the config and arguments
+    # are known to be valid, since they're slow to import
+    import requests
+    from dhooks import Webhook
+    from plexapi.server import PlexServer
+
+    # A single session is shared by plex and the uptime status ping so
+    # connections are kept alive and reused. Caches the plex server's
+    # identity and library section listings on disk if specified, since
+    # they're requested on every run but rarely change. Searches are never
+    # cached so that newly added media is always picked up.
+    if cache_expiry:
+        from requests_cache import CachedSession, DO_NOT_CACHE
+        session = CachedSession(
+            cache_file,
+            allowable_methods=("GET",),
+            urls_expire_after={
+                # Matches "/", "/library" and "/library/sections" only
+                re.compile(r"://[^/]+/(library(/sections)?)?$"):
+                    timedelta(minutes=cache_expiry),
+                "*": DO_NOT_CACHE,
+            })
+    else:
+        session = requests.Session()
+
+    # Initializing plex and webhook connections
+    plex = PlexServer(plex_url, plex_token, session=session)
     webhook = Webhook(webhook_url)
-    webhook_embeds = []
-    media_lists = []
 
-    # Skips scanning libraries if specified
-    if not skip_movies:
-        movies = plex.library.section(movie_library)
-        # Retrieves all movies added since the start of the lookback period
-        new_movies = movies.search(filters={"addedAt>>": lookback_period})
-        # Raises a flag to skip the movie embed
-        # creation/addition if there are no new movies
-        if not new_movies:
-            skip_movies = True
-        else:
-            # Building movies list
-            movies_str = bullet
-            new_movies_formatted = [clean_year(movie) for movie in new_movies]
-            total_movies = len(new_movies_formatted)
-            movies_str += ("\n" + bullet).join(new_movies_formatted)
-            media_lists.append(movies_str)
-
-            # Pluralizes "Movie" title string if appropriate
-            movies_title_counted = "Movie"
-            if total_movies != 1:
-                movies_title_counted += "s"
-
-            # Builds the Movies embed title
-            movie_title = (f"{total_movies} {movies_title_counted}"
-                           f" {movie_emote}")
-    if not skip_tv:
-        shows = plex.library.section(tv_library)
-        # Retrieves all TV episodes added since the start of the lookback
-        # period.
-        new_eps = shows.searchEpisodes(filters={"addedAt>>": lookback_period})
-        # Raises a flag to skip the TV show embed creation/addition if there
-        # are no new episodes
-        if not new_eps:
-            skip_tv = True
-        else:
-            # Building TV shows list
-            newShows = []
-            for episode in new_eps:
-                # Cannot directly retrieve the Show object from the Episode
-                # object so I'm using the workaround to search by unique
-                # RatingKey instead.
-                newShows.append(clean_year(
-                                plex.fetchItem(episode.grandparentRatingKey)))
-
-            # Counts the duplicates and builds the
-            # properly-formatted list with episode counts
-            counted_shows = Counter(newShows)
-            show_list = []
-            total_episodes = 0
-
-            # Loops through the dictionary of shows with their counts
-            for counted_show in counted_shows:
-                # Retrieves the number of new episodes for the current show
-                episode_count = counted_shows[counted_show]
-                total_episodes += episode_count
-                episodes_counted = "episode"
-                # Pluralizes "episode" string if appropriate
-                if episode_count > 1:
-                    episodes_counted += "s"
-                if show_individual_episodes:
-                    show_list.append(f"{bullet}{counted_show} -"
-                                     f" *{episode_count} {episodes_counted}*")
-                else:
-                    show_list.append(bullet + counted_show)
-            show_list.sort()
-            total_shows = len(show_list)
-            tv_str = "\n".join(show_list)
-            media_lists.append(tv_str)
-
-            # Pluralizes "TV Show" and "Episode" title strings if appropriate
-            show_title_counted = "Show"
-            episode_title_counted = "Episode"
-            # Case for multiple shows, therefore multiple episodes
-            if total_shows > 1:
-                episode_title_counted += "s"
-                show_title_counted += "s"
-            # Case where there is only one show, but has multiple episodes
-            elif episode_count > 1:
-                show_title_counted += "s"
-
-            if show_total_episodes:
-                # Builds the TV Shows embed title with the episode count
-                tv_title = (f"{total_shows} {show_title_counted} /"
-                            f" {total_episodes} {episode_title_counted}"
-                            f" {tv_emote}")
-            else:
-                # Builds the TV Shows embed title
-                tv_title = (f"{total_shows} {show_title_counted} {tv_emote}")
-
-    # Building embeds
-    list_count = len(media_lists)
-    if ((sum([len(descr) for descr in media_lists]) < message_max_length)):
-        # Sets to max message length if the sum of both lists is less than it
-        embed_length = message_max_length
-    else:
-        # Sets to max message length if there is only
-        # one list. Otherwise divides the total embed
-        # length by however many lists there are.
-        embed_length = message_max_length // list_count
-
-    if not skip_movies:
-        create_embeds(movie_title, movies_str, movie_embed_colour,
-                      embed_length)
-    if not skip_tv:
-        create_embeds(tv_title, tv_str, tv_embed_colour, embed_length)
-
-    # Adds thumnail image to embeds if specified
-    [embed.set_thumbnail(embed_thumbnail) for embed in webhook_embeds]
-
-    # Sending webhook
-    if webhook_embeds:
-        try:
-            webhook.send(message_title, embeds=webhook_embeds)
-        except Exception as err:
-            print("There was an error sending the message:", err)
+    if not args.daemon:
+        run_once(plex, webhook, session)
     else:
-        print("No new/specified media to notify about - message not sent.")
-
-    # Ping uptime status monitor if specified
-    if uptime_status:
-        try:
-            requests.get(f"{uptime_status}{int(time.time()) - start_time}")
-        except Exception as err:
-            print(f"There was an error pinging the uptime status monitor:",
-                  err)
+        next_run = time.monotonic()
+        while True:
+            try:
+                run_once(plex, webhook, session)
+            except Exception as err:
+                print("There was an error checking for new media:", err)
+            # Schedules the next run one lookback period after the start of
+            # the previous one, or right away if the previous run took longer
+            # than that, without trying to catch up on missed runs
+            next_run = max(next_run + lookback_seconds, time.monotonic())
+            time.sleep(max(0, next_run - time.monotonic()))